@@ -5,19 +5,121 @@ Automatically syncs DHCP leases from Unifi controller to Pi-hole DNS records
 """
 
 import requests
+import orjson
+import ijson
 import json
 import logging
+import logging.handlers
+import atexit
 import argparse
 import sys
 import os
 import re
+import time
+import ipaddress
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from urllib.parse import quote
-from collections import Counter
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 requests.packages.urllib3.disable_warnings()
 
+# Number of concurrent DNS record writes to Pi-hole
+MAX_WORKERS = 16
+
+# Seconds a cached copy of the Pi-hole DNS records stays valid
+HOSTS_CACHE_TTL = 60
+
+# Fallback lifetime of a cached Pi-hole session if the API doesn't report one
+SESSION_CACHE_TTL = 1800
+
+# Bounds in seconds for the adaptive sync interval
+MIN_SYNC_INTERVAL = 60
+MAX_SYNC_INTERVAL = 3600
+
+# Slack in seconds for cron start jitter when checking whether a sync is due
+SYNC_INTERVAL_GRACE = 5
+
+# Re-check Pi-hole's records after this many runs served from the local shadow
+RECONCILE_EVERY = 10
+
+# Hostname sanitization: spaces become hyphens, then anything that isn't
+# valid in a DNS label (including apostrophes and smart quotes) is dropped
+SPACE_TO_HYPHEN = str.maketrans(' ', '-')
+INVALID_HOSTNAME_CHARS = re.compile(r'[^a-z0-9\-\.]')
+
+# Client fields read from the Unifi stat/sta response; everything else is skipped
+CLIENT_FIELDS = {
+    'data.item.ip': 'ip',
+    'data.item.hostname': 'hostname',
+    'data.item.name': 'name',
+}
+
+def write_json_atomic(path, data, mode=0o644):
+    """Write JSON to a temporary file and move it into place"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def create_session():
+    """Create a session with a sized connection pool and retries on gateway errors"""
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    # Size the pool so concurrent requests reuse keep-alive connections
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class SubnetMatcher:
+    """Match IPv4 addresses against prefixes (e.g. 192.168.1.) and CIDR networks"""
+    def __init__(self, subnets):
+        self.subnets = subnets
+        self.prefixes = tuple(s for s in subnets if '/' not in s)
+
+        # Merge CIDR networks into sorted, non-overlapping integer ranges
+        ranges = []
+        for start, end in sorted(self._network_range(s) for s in subnets if '/' in s):
+            if ranges and start <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        self.starts = [r[0] for r in ranges]
+        self.ends = [r[1] for r in ranges]
+
+    def __bool__(self):
+        return bool(self.subnets)
+
+    @staticmethod
+    def _network_range(subnet):
+        try:
+            network = ipaddress.IPv4Network(subnet, strict=False)
+        except ValueError:
+            raise ValueError(f"Invalid subnet: {subnet}") from None
+        return int(network.network_address), int(network.broadcast_address)
+
+    def matches(self, ip):
+        """Check whether an IP falls within any configured subnet"""
+        if self.prefixes and ip.startswith(self.prefixes):
+            return True
+        if not self.starts:
+            return False
+
+        try:
+            value = int(ipaddress.IPv4Address(ip))
+        except ValueError:
+            return False
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
 class Config:
     """Configuration management"""
     def __init__(self, config_file=None):
@@ -47,6 +149,9 @@ class Config:
         self.log_file = os.getenv('LOG_FILE', '/var/log/unipiSync.log')
         self.log_level = os.getenv('LOG_LEVEL', 'INFO')
 
+        self.cache_dir = os.getenv('CACHE_DIR', '/var/cache/unipiSync')
+        self.adaptive_interval = os.getenv('ADAPTIVE_INTERVAL', 'false').lower() in ('1', 'true', 'yes')
+
         self.validate()
 
     def validate(self):
@@ -63,6 +168,10 @@ class Config:
         if missing:
             raise ValueError(f"Missing required configuration: {', '.join(missing)}")
 
+        # Raises ValueError on malformed CIDR entries
+        SubnetMatcher(self.allowed_subnets)
+        SubnetMatcher(self.excluded_subnets)
+
 class UnifiController:
     """Unifi Controller API client"""
     def __init__(self, config):
@@ -71,44 +180,38 @@ class UnifiController:
         self.site = config.unifi_site
         self.allowed_subnets = config.allowed_subnets
         self.excluded_subnets = config.excluded_subnets
-        self.session = requests.Session()
+        self._allowed = SubnetMatcher(self.allowed_subnets)
+        self._excluded = SubnetMatcher(self.excluded_subnets)
+        self.session = create_session()
         self.session.verify = False
         self.session.headers.update({'X-API-KEY': self.api_token})
 
     def get_active_clients(self):
-        """Retrieve active DHCP clients from Unifi controller"""
+        """Retrieve active DHCP clients from Unifi controller as parallel (ips, hostnames) lists"""
         try:
             url = f"{self.base_url}/proxy/network/api/s/{self.site}/stat/sta"
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            clients = response.json().get('data', [])
-
-            client_list = []
-            for client in clients:
-                ip = client.get('ip')
-                hostname = client.get('hostname') or client.get('name')
+            ips = []
+            hostnames = []
+            with self.session.get(url, stream=True, timeout=10) as response:
+                response.raise_for_status()
 
-                if not ip or not hostname:
-                    continue
+                for ip, hostname in self._iter_clients(response):
+                    if not ip or not hostname:
+                        continue
 
-                # Filter by excluded subnets first (takes precedence)
-                if self.excluded_subnets:
-                    if any(ip.startswith(subnet) for subnet in self.excluded_subnets):
+                    # Filter by excluded subnets first (takes precedence)
+                    if self._excluded and self._excluded.matches(ip):
                         continue
 
-                # Filter by allowed subnets if configured
-                if self.allowed_subnets:
-                    if not any(ip.startswith(subnet) for subnet in self.allowed_subnets):
+                    # Filter by allowed subnets if configured
+                    if self._allowed and not self._allowed.matches(ip):
                         continue
 
-                clean_hostname = self._sanitize_hostname(hostname)
-                client_list.append({
-                    'ip': ip,
-                    'hostname': clean_hostname
-                })
+                    ips.append(ip)
+                    hostnames.append(self._sanitize_hostname(hostname))
 
             # Handle duplicate hostnames
-            active_clients = self._handle_duplicates(client_list)
+            hostnames = self._handle_duplicates(ips, hostnames)
 
             # Build descriptive log message
             filter_parts = []
@@ -118,40 +221,43 @@ class UnifiController:
                 filter_parts.append(f"excluding {', '.join(self.excluded_subnets)}")
 
             filter_msg = f" ({', '.join(filter_parts)})" if filter_parts else " (all subnets)"
-            logging.info(f"Found {len(active_clients)} active clients{filter_msg}")
-            return active_clients
+            logging.info(f"Found {len(ips)} active clients{filter_msg}")
+            return ips, hostnames
         except Exception as e:
             logging.error(f"Failed to get active clients from Unifi: {e}")
-            return []
+            return [], []
+
+    def _iter_clients(self, response):
+        """Stream (ip, hostname) pairs from a client list without decoding unused fields"""
+        response.raw.decode_content = True
+        fields = {}
+        for prefix, event, value in ijson.parse(response.raw):
+            if prefix == 'data.item':
+                if event == 'start_map':
+                    fields = {}
+                elif event == 'end_map':
+                    yield fields.get('ip'), fields.get('hostname') or fields.get('name')
+            elif prefix in CLIENT_FIELDS:
+                fields[CLIENT_FIELDS[prefix]] = value
 
     def _sanitize_hostname(self, hostname):
         """Sanitize hostname for DNS compatibility"""
-        clean = hostname.lower().replace(' ', '-')
-        clean = re.sub(r"['\u2019]", '', clean)
-        clean = re.sub(r'[^a-z0-9\-\.]', '', clean)
-        return clean
+        return INVALID_HOSTNAME_CHARS.sub('', hostname.lower().translate(SPACE_TO_HYPHEN))
 
-    def _handle_duplicates(self, client_list):
+    def _handle_duplicates(self, ips, hostnames):
         """Handle duplicate hostnames by appending IP last octet"""
-        hostname_counts = Counter([c['hostname'] for c in client_list])
-        active_clients = []
-
-        for client in client_list:
-            hostname = client['hostname']
-            ip = client['ip']
+        groups = defaultdict(list)
+        for i, hostname in enumerate(hostnames):
+            groups[hostname].append(i)
 
-            if hostname_counts[hostname] > 1:
-                last_octet = ip.split('.')[-1]
-                unique_hostname = f"{hostname}-{last_octet}"
-            else:
-                unique_hostname = hostname
-
-            active_clients.append({
-                'ip': ip,
-                'hostname': unique_hostname
-            })
+        # Only rename hostnames that actually collide
+        unique_hostnames = list(hostnames)
+        for hostname, indexes in groups.items():
+            if len(indexes) > 1:
+                for i in indexes:
+                    unique_hostnames[i] = f"{hostname}-{ips[i].rpartition('.')[2]}"
 
-        return active_clients
+        return unique_hostnames
 
 class PiholeAPI:
     """Pi-hole API client"""
@@ -159,39 +265,76 @@ class PiholeAPI:
         self.host = config.pihole_host
         self.password = config.pihole_password
         self.domain = config.dns_domain
-        self.session = requests.Session()
+        self.session = create_session()
         self.sid = None
         self.csrf_token = None
+        # Raw host entries fetched from Pi-hole this run, used for bulk updates.
+        # Never set from the local cache, which can't see edits made outside unipiSync.
+        self.hosts = None
+        self._cache_path = os.path.join(config.cache_dir, 'hosts.json')
+        self._session_path = os.path.join(config.cache_dir, 'sid.json')
+        # False until Pi-hole has accepted a session, and again if it is lost and can't be renewed
+        self.session_valid = False
+        self._auth_lock = threading.Lock()
 
     def authenticate(self):
-        """Authenticate to Pi-hole API"""
+        """Authenticate to Pi-hole API, reusing a cached session if Pi-hole still accepts it"""
+        if self._load_cached_session():
+            # Validate the session with the hosts fetch the sync needs anyway
+            try:
+                url = f"http://{self.host}/api/config/dns/hosts"
+                response = self.session.get(url, headers=self._auth_headers(), timeout=10)
+                if response.status_code not in (401, 403):
+                    response.raise_for_status()
+                    self._store_hosts(response)
+                    self.session_valid = True
+                    logging.info("Reusing cached Pi-hole session")
+                    return True
+                logging.info("Cached Pi-hole session expired, re-authenticating")
+            except Exception as e:
+                logging.error(f"Failed to validate cached Pi-hole session: {e}")
+                return False
+        return self._login()
+
+    def _login(self):
+        """Log in to Pi-hole with the admin password and cache the new session"""
         try:
             url = f"http://{self.host}/api/auth"
             data = {"password": self.password}
-            response = self.session.post(url, json=data, timeout=10)
+            headers = {'Content-Type': 'application/json'}
+            response = self.session.post(url, headers=headers, data=orjson.dumps(data), timeout=10)
             response.raise_for_status()
-            result = response.json()
+            result = orjson.loads(response.content)
             self.sid = result.get('session', {}).get('sid')
             self.csrf_token = result.get('session', {}).get('csrf')
             if self.sid and self.csrf_token:
                 logging.info("Successfully authenticated to Pi-hole")
+                validity = result.get('session', {}).get('validity') or SESSION_CACHE_TTL
+                self._save_cached_session(validity)
+                self.session_valid = True
                 return True
+            self.session_valid = False
             return False
         except Exception as e:
             logging.error(f"Failed to authenticate to Pi-hole: {e}")
+            self.session_valid = False
             return False
 
     def get_existing_records(self):
         """Retrieve existing DNS records from Pi-hole"""
         try:
-            url = f"http://{self.host}/api/config/dns/hosts"
-            headers = {
-                'X-FTL-SID': self.sid,
-                'X-FTL-CSRF-TOKEN': self.csrf_token
-            }
-            response = self.session.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            records = response.json().get('config', {}).get('dns', {}).get('hosts', [])
+            if self.hosts is not None:
+                # Already fetched while validating a cached session
+                records = self.hosts
+            else:
+                records = self._load_cached_hosts()
+                if records is None:
+                    url = f"http://{self.host}/api/config/dns/hosts"
+                    response = self._request('GET', url)
+                    response.raise_for_status()
+                    records = self._store_hosts(response)
+                else:
+                    logging.debug(f"Using cached DNS records from {self._cache_path}")
 
             existing = {}
             for record in records:
@@ -206,99 +349,359 @@ class PiholeAPI:
             logging.error(f"Failed to get existing DNS records: {e}")
             return {}
 
-    def add_dns_record(self, domain, ip):
-        """Add or update DNS record in Pi-hole"""
-        try:
-            fqdn = f"{domain}.{self.domain}"
-            encoded_record = quote(f"{ip} {fqdn}")
-            url = f"http://{self.host}/api/config/dns/hosts/{encoded_record}"
+    def _store_hosts(self, response):
+        """Keep the hosts list from a Pi-hole response for this run and the local cache"""
+        records = orjson.loads(response.content).get('config', {}).get('dns', {}).get('hosts', [])
+        self._save_cached_hosts(records)
+        self.hosts = records
+        return records
 
-            headers = {
-                'X-FTL-SID': self.sid,
-                'X-FTL-CSRF-TOKEN': self.csrf_token
-            }
+    def set_all_records(self, records):
+        """Replace all DNS records in Pi-hole with a single request
 
-            response = self.session.put(url, headers=headers, timeout=10)
+        Returns None if Pi-hole rejects the bulk update with a client error,
+        so the caller can fall back to per-record updates.
+        """
+        try:
+            url = f"http://{self.host}/api/config/dns"
+            headers = {'Content-Type': 'application/json'}
+            data = orjson.dumps({"config": {"dns": {"hosts": records}}})
+
+            response = self._request('PATCH', url, headers=headers, data=data)
+            if 400 <= response.status_code < 500 and response.status_code not in (401, 403):
+                logging.warning(f"Bulk DNS update not supported (HTTP {response.status_code}), "
+                                f"falling back to per-record updates")
+                return None
             response.raise_for_status()
+            self._invalidate_cache()
             return True
         except Exception as e:
-            logging.error(f"Failed to add DNS record {domain} -> {ip}: {e}")
+            logging.error(f"Failed to update DNS records: {e}")
+            return False
+
+    def add_dns_record(self, fqdn, ip):
+        """Add or update DNS record in Pi-hole, raising requests.RequestException on failure"""
+        encoded_record = '%20'.join((quote(ip), quote(fqdn, safe='')))
+        url = f"http://{self.host}/api/config/dns/hosts/{encoded_record}"
+
+        response = self._request('PUT', url)
+        response.raise_for_status()
+        self._invalidate_cache()
+
+    def _request(self, method, url, headers=None, **kwargs):
+        """Send an authenticated request, logging in again if Pi-hole dropped the session"""
+        sid = self.sid
+        response = self.session.request(method, url, headers=self._auth_headers(headers),
+                                        timeout=10, **kwargs)
+        if response.status_code not in (401, 403):
+            return response
+
+        # Concurrent writers may all be rejected; only the first one logs in again
+        with self._auth_lock:
+            if self.sid == sid and self.session_valid:
+                logging.info("Pi-hole session expired, re-authenticating")
+                self._login()
+            if not self.session_valid:
+                return response
+
+        response = self.session.request(method, url, headers=self._auth_headers(headers),
+                                        timeout=10, **kwargs)
+        if response.status_code in (401, 403):
+            # Rejected even with a fresh session, so stop trying to log in again
+            self.session_valid = False
+        return response
+
+    def _auth_headers(self, headers=None):
+        """Build request headers carrying the current Pi-hole session"""
+        auth_headers = {
+            'X-FTL-SID': self.sid,
+            'X-FTL-CSRF-TOKEN': self.csrf_token
+        }
+        if headers:
+            auth_headers.update(headers)
+        return auth_headers
+
+    def _load_cached_session(self):
+        """Restore a cached Pi-hole session if it hasn't expired"""
+        try:
+            with open(self._session_path) as f:
+                cached = json.load(f)
+            if cached['expires'] > time.time() and cached['sid'] and cached['csrf']:
+                self.sid = cached['sid']
+                self.csrf_token = cached['csrf']
+                return True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return False
+
+    def _save_cached_session(self, validity):
+        """Write the current Pi-hole session to a file readable only by this user"""
+        try:
+            cached = {
+                'sid': self.sid,
+                'csrf': self.csrf_token,
+                'ts': time.time(),
+                'expires': time.time() + validity
+            }
+            write_json_atomic(self._session_path, cached, mode=0o600)
+        except OSError as e:
+            logging.debug(f"Cannot write Pi-hole session cache: {e}")
+
+    def _load_cached_hosts(self):
+        """Return cached DNS records if the cache is still fresh, otherwise None"""
+        try:
+            if os.path.getmtime(self._cache_path) > time.time() - HOSTS_CACHE_TTL:
+                with open(self._cache_path) as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _save_cached_hosts(self, records):
+        """Atomically write DNS records to the local cache"""
+        try:
+            write_json_atomic(self._cache_path, records)
+        except OSError as e:
+            logging.debug(f"Cannot write DNS record cache: {e}")
+
+    def _invalidate_cache(self):
+        """Remove the cached DNS records after Pi-hole has been changed"""
+        try:
+            os.remove(self._cache_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.debug(f"Cannot remove DNS record cache: {e}")
+
+class AdaptiveSchedule:
+    """Back off the sync interval on quiet networks and tighten it after changes"""
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'state.json')
+        # Runs are timed from their start so a sync's own duration doesn't push back the next one
+        self.started = time.time()
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    @property
+    def interval(self):
+        return self.state.get('current_interval', MIN_SYNC_INTERVAL)
+
+    def is_due(self):
+        """Check whether the current interval has elapsed since the last sync"""
+        elapsed = self.started - self.state.get('last_run_ts', 0)
+        return elapsed + SYNC_INTERVAL_GRACE >= self.interval
+
+    def record(self, changes):
+        """Double the interval after a run without changes, halve it otherwise"""
+        if changes:
+            interval = self.interval // 2
+            self.state['last_change_ts'] = self.started
+        else:
+            interval = self.interval * 2
+        self.state['current_interval'] = max(MIN_SYNC_INTERVAL, min(MAX_SYNC_INTERVAL, interval))
+        self.state['last_run_ts'] = self.started
+
+        try:
+            write_json_atomic(self.path, self.state)
+        except OSError as e:
+            logging.debug(f"Cannot write sync state: {e}")
+        logging.debug(f"Next sync in {self.state['current_interval']}s")
+
+class SyncShadow:
+    """Local copy of the records written by the last successful sync"""
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'shadow.json')
+        try:
+            with open(self.path) as f:
+                shadow = json.load(f)
+            self.records = shadow['records']
+            self.runs = shadow['runs']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.records = None
+            self.runs = 0
+
+    def needs_reconcile(self):
+        """Check whether this run must read Pi-hole's records regardless of the clients"""
+        return self.records is None or self.runs >= RECONCILE_EVERY
+
+    def is_current(self, desired):
+        """Check whether Pi-hole can be assumed to already match the desired records"""
+        if self.needs_reconcile():
             return False
+        return all(self.records.get(fqdn) == ip for fqdn, ip in desired.items())
+
+    def save(self, desired, reconciled):
+        """Remember the desired records, restarting the count after a full check"""
+        if reconciled:
+            self.records = dict(desired)
+            self.runs = 0
+        else:
+            self.runs += 1
+
+        try:
+            write_json_atomic(self.path, {'records': self.records, 'runs': self.runs})
+        except OSError as e:
+            logging.debug(f"Cannot write sync shadow: {e}")
+
+def write_records_individually(pihole, to_write, existing_records):
+    """Write DNS records one request at a time, returning (added, updated, failed)"""
+    added = 0
+    updated = 0
+    failed = 0
 
-def sync_dhcp_to_dns(config, dry_run=False):
+    # Writes are independent, so issue them concurrently over the pooled session
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(pihole.add_dns_record, fqdn, ip): (fqdn, ip)
+            for fqdn, ip in to_write.items()
+        }
+
+        # Results are tallied here in the main thread, so no locking is needed
+        for future in as_completed(futures):
+            fqdn, ip = futures[future]
+            error = future.exception()
+
+            if error is not None:
+                # Only network and HTTP errors count as a failed record; anything else is a bug
+                if not isinstance(error, requests.RequestException):
+                    raise error
+                logging.error(f"Failed to add DNS record {fqdn} -> {ip}: {error}")
+                failed += 1
+            elif fqdn in existing_records:
+                logging.info(f"Updated {fqdn}: {existing_records[fqdn]} -> {ip}")
+                updated += 1
+            else:
+                logging.info(f"Added {fqdn} -> {ip}")
+                added += 1
+
+    return added, updated, failed
+
+def connect_pihole(pihole):
+    """Authenticate to Pi-hole and fetch its existing records, or return None if login fails"""
+    if not pihole.authenticate():
+        return None
+    existing_records = pihole.get_existing_records()
+    # The session may have been rejected mid-fetch with no way to log in again
+    if not pihole.session_valid:
+        return None
+    return existing_records
+
+def sync_dhcp_to_dns(config, dry_run=False, schedule=None):
     """Main sync function"""
     logging.info("=" * 50)
     logging.info(f"Starting unipiSync{' (DRY RUN)' if dry_run else ''}")
 
-    # Get active clients from Unifi
     unifi = UnifiController(config)
-    clients = unifi.get_active_clients()
+    pihole = PiholeAPI(config)
+    shadow = SyncShadow(config.cache_dir)
 
-    if not clients:
+    # When Pi-hole has to be read anyway, fetch from it while Unifi is queried
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pihole_future = None
+        if dry_run or shadow.needs_reconcile():
+            pihole_future = executor.submit(connect_pihole, pihole)
+
+        # Get active clients from Unifi
+        ips, hostnames = unifi.get_active_clients()
+
+    if not ips:
         logging.warning("No active clients found - nothing to sync")
         return True
 
-    # Authenticate to Pi-hole
-    pihole = PiholeAPI(config)
-    if not pihole.authenticate():
+    suffix = f".{config.dns_domain}"
+    desired = dict(zip([hostname + suffix for hostname in hostnames], ips))
+
+    # Skip Pi-hole entirely if nothing changed since the last successful sync
+    if not dry_run and shadow.is_current(desired):
+        shadow.save(desired, reconciled=False)
+        logging.info(f"Sync complete: 0 added, 0 updated, {len(desired)} skipped, 0 failed "
+                     f"(unchanged since last sync)")
+        logging.info("=" * 50)
+        if schedule:
+            schedule.record(0)
+        return True
+
+    # Authenticate to Pi-hole and get existing records
+    existing_records = pihole_future.result() if pihole_future else connect_pihole(pihole)
+    if existing_records is None:
         logging.error("Aborting sync - Pi-hole authentication failed")
         return False
 
-    # Get existing records
-    existing_records = pihole.get_existing_records()
+    # Diff clients against existing records before any writes
+    to_write = {fqdn: ip for fqdn, ip in desired.items() if existing_records.get(fqdn) != ip}
+    skipped = len(desired) - len(to_write)
 
-    # Sync clients
     added = 0
     updated = 0
-    skipped = 0
     failed = 0
 
-    for client in clients:
-        fqdn = f"{client['hostname']}.{config.dns_domain}"
-        ip = client['ip']
-
-        if fqdn in existing_records:
-            if existing_records[fqdn] == ip:
-                skipped += 1
+    if dry_run:
+        for fqdn, ip in to_write.items():
+            if fqdn in existing_records:
+                logging.info(f"[DRY RUN] Would update {fqdn}: {existing_records[fqdn]} -> {ip}")
+                updated += 1
             else:
-                if dry_run:
-                    logging.info(f"[DRY RUN] Would update {fqdn}: {existing_records[fqdn]} -> {ip}")
-                    updated += 1
-                else:
-                    if pihole.add_dns_record(client['hostname'], ip):
-                        logging.info(f"Updated {fqdn}: {existing_records[fqdn]} -> {ip}")
-                        updated += 1
-                    else:
-                        failed += 1
-        else:
-            if dry_run:
                 logging.info(f"[DRY RUN] Would add {fqdn} -> {ip}")
                 added += 1
-            else:
-                if pihole.add_dns_record(client['hostname'], ip):
+    elif to_write:
+        result = None
+        if pihole.hosts is not None:
+            # Keep untouched entries and replace the rest with the new mappings
+            hosts = [h for h in pihole.hosts if len(h.split()) < 2 or h.split()[1] not in to_write]
+            hosts.extend(f"{ip} {fqdn}" for fqdn, ip in to_write.items())
+            result = pihole.set_all_records(hosts)
+
+        if result is None:
+            added, updated, failed = write_records_individually(
+                pihole, to_write, existing_records
+            )
+        elif result:
+            for fqdn, ip in to_write.items():
+                if fqdn in existing_records:
+                    logging.info(f"Updated {fqdn}: {existing_records[fqdn]} -> {ip}")
+                    updated += 1
+                else:
                     logging.info(f"Added {fqdn} -> {ip}")
                     added += 1
-                else:
-                    failed += 1
+        else:
+            failed = len(to_write)
 
     logging.info(f"Sync complete: {added} added, {updated} updated, {skipped} skipped, {failed} failed")
     logging.info("=" * 50)
+
+    if not dry_run and failed == 0:
+        # Only trust the shadow if Pi-hole's records were actually read this run
+        if pihole.hosts is not None:
+            shadow.save(desired, reconciled=True)
+        if schedule:
+            schedule.record(added + updated)
     return failed == 0
 
 def setup_logging(log_file, log_level, verbose=False):
     """Configure logging"""
     level = logging.DEBUG if verbose else getattr(logging, log_level.upper(), logging.INFO)
 
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
     handlers = [logging.StreamHandler()]
 
     try:
-        handlers.append(logging.FileHandler(log_file))
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter(log_format))
+        # Buffer file output so a sync's records are written together at exit
+        memory_handler = logging.handlers.MemoryHandler(
+            capacity=1024, flushLevel=logging.ERROR, target=file_handler
+        )
+        atexit.register(memory_handler.flush)
+        handlers.append(memory_handler)
     except PermissionError:
         print(f"Warning: Cannot write to {log_file}, logging to stdout only")
 
     logging.basicConfig(
         level=level,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+        format=log_format,
         handlers=handlers
     )
 
@@ -322,6 +725,11 @@ def main():
         action='store_true',
         help='Enable verbose (debug) logging'
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Sync now even if the adaptive interval has not elapsed'
+    )
 
     args = parser.parse_args()
 
@@ -329,7 +737,12 @@ def main():
         config = Config(args.config)
         setup_logging(config.log_file, config.log_level, args.verbose)
 
-        success = sync_dhcp_to_dns(config, dry_run=args.dry_run)
+        schedule = AdaptiveSchedule(config.cache_dir) if config.adaptive_interval else None
+        if schedule and not (args.force or args.dry_run) and not schedule.is_due():
+            logging.debug(f"Skipping sync - adaptive interval of {schedule.interval}s has not elapsed")
+            sys.exit(0)
+
+        success = sync_dhcp_to_dns(config, dry_run=args.dry_run, schedule=schedule)
         sys.exit(0 if success else 1)
 
     except ValueError as e: